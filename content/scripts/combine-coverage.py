@@ -5,20 +5,35 @@ Coverage artifacts must be named using the format: "Coverage $(System.JobAttempt
 The recommended coverage artifact name format is: Coverage $(System.JobAttempt) $(System.StageDisplayName) $(System.JobDisplayName)
 Keep in mind that Azure Pipelines does not enforce unique job display names (only names).
 It is up to pipeline authors to avoid name collisions when deviating from the recommended format.
+Files with identical content are only copied once, since they contribute nothing further to the combined results.
+This applies to Python coverage data, which is combined by line, and to PowerShell coverage data without any line hits, such as stubs.
+PowerShell coverage data with line hits is always copied, since ansible-test adds the hit counts together when combining.
+The labels of all jobs which provided each copied file are recorded in "coverage-labels.json" in the output directory.
+Stage coverage artifacts, which contain coverage data already reduced for a stage, use the "Stage Coverage" prefix instead.
 """
 
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import argparse
+import hashlib
+import json
 import os
 import re
 import shutil
-import sys
 
 
 def main():
     """Main program entry point."""
-    source_directory = sys.argv[1]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source_directory', help='directory containing the downloaded coverage artifacts')
+    parser.add_argument('--prefix', default='Coverage', help='name prefix of the coverage artifacts')
+    parser.add_argument('--labels', help='"|" separated list of job labels to process, all others are ignored')
+
+    args = parser.parse_args()
+
+    source_directory = args.source_directory
+    selected_labels = set(label.strip() for label in args.labels.split('|')) if args.labels else None
 
     if '/ansible_collections/' in os.getcwd():
         output_path = "tests/output"
@@ -34,27 +49,79 @@ def main():
     count = 0
 
     for name in os.listdir(source_directory):
-        match = re.search('^Coverage (?P<attempt>[0-9]+) (?P<label>.+)$', name)
+        match = re.search('^%s (?P<attempt>[0-9]+) (?P<label>.+)$' % re.escape(args.prefix), name)
         label = match.group('label')
         attempt = int(match.group('attempt'))
+
+        if selected_labels is not None and label.strip() not in selected_labels:
+            continue
+
         jobs[label] = max(attempt, jobs.get(label, 0))
 
-    for label, attempt in jobs.items():
-        name = 'Coverage {attempt} {label}'.format(label=label, attempt=attempt)
+    copies = {}
+    labels = {}
+    duplicate_count = 0
+    duplicate_bytes = 0
+
+    for label, attempt in sorted(jobs.items()):
+        name = '{prefix} {attempt} {label}'.format(prefix=args.prefix, label=label, attempt=attempt)
         source = os.path.join(source_directory, name)
-        source_files = os.listdir(source)
+        source_files = sorted(os.listdir(source))
 
         for source_file in source_files:
             source_path = os.path.join(source, source_file)
-            destination_path = os.path.join(destination_directory, source_file + '.' + label)
-            print('"%s" -> "%s"' % (source_path, destination_path))
-            shutil.copyfile(source_path, destination_path)
-            count += 1
+            key = (source_file, get_file_hash(source_path))
+
+            if key in copies and not has_hit_counts(source_path):
+                destination_path = copies[key]
+                duplicate_count += 1
+                duplicate_bytes += os.path.getsize(source_path)
+                print('"%s" == "%s"' % (source_path, destination_path))
+            else:
+                destination_path = os.path.join(destination_directory, source_file + '.' + label)
+                copies[key] = destination_path
+                print('"%s" -> "%s"' % (source_path, destination_path))
+                shutil.copyfile(source_path, destination_path)
+                count += 1
+
+            labels.setdefault(os.path.basename(destination_path), []).append(label)
+
+    with open(os.path.join(output_path, 'coverage-labels.json'), 'w') as labels_file:
+        json.dump(labels, labels_file, indent=4, sort_keys=True)
 
     print('Coverage file count: %d' % count)
+    print('Skipped %d duplicate coverage files totaling %d bytes.' % (duplicate_count, duplicate_bytes))
     print('##vso[task.setVariable variable=coverageFileCount]%d' % count)
     print('##vso[task.setVariable variable=outputPath]%s' % output_path)
 
 
+def has_hit_counts(path):
+    """Return True if the given file contains PowerShell coverage data with line hits, which are added together when combining."""
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    # Python coverage data is stored in SQLite or the older coverage.py format, neither of which is JSON.
+    if not data.lstrip().startswith(b'{'):
+        return False
+
+    try:
+        coverage = json.loads(data.decode())
+    except ValueError:
+        return False
+
+    return any(hits for lines in coverage.values() if isinstance(lines, dict) for hits in lines.values())
+
+
+def get_file_hash(path):
+    """Return the SHA-256 digest of the given file."""
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(65536), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
 if __name__ == '__main__':
     main()
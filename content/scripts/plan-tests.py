@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Determine which of the given tests are unaffected by a pull request, using ansible-test change detection.
+The result is published as the "skip" output variable, a space delimited list of tests with a leading and trailing space.
+Tests are only skipped when change detection positively shows that none of the integration targets they would run have changed.
+Unrecognized tests are never skipped, and nothing is skipped for builds which are not pull requests or when change detection fails.
+Changed targets are read from the change classification which ansible-test reports before filtering targets for the current environment.
+Otherwise targets which the test jobs run, such as destructive, unsupported, cloud or Python version specific targets, could be missed.
+If the classification cannot be read, nothing is skipped.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import re
+import subprocess
+import sys
+
+# Mapping of test script names to the integration target alias category (shippable/{category}/group{N}) they run.
+categories = dict(
+    linux='posix',
+    osx='posix',
+    macos='posix',
+    rhel='posix',
+    freebsd='posix',
+    windows='windows',
+    aws='aws',
+    azure='azure',
+    cloud='cloud',
+    cs='cs',
+    hcloud='hcloud',
+    tower='tower',
+    vcenter='vcenter',
+)
+
+# Test script names which take a platform version, so a single parameter is never a group.
+platform_types = ('linux', 'osx', 'macos', 'rhel', 'freebsd', 'windows')
+
+# ansible-test commands used to list the changed integration targets.
+commands = ('integration', 'windows-integration')
+
+# Options which stop ansible-test from excluding targets that the test jobs run, since they use these options or run as root in containers.
+allow_options = ('--allow-destructive', '--allow-unsupported', '--allow-unstable', '--allow-disabled', '--allow-root')
+
+# Pattern matching the change classification of a changed path, which ansible-test reports when run with -v.
+classification_pattern = re.compile(r'^(?P<path>.+) -> (?:(?P<command>[a-z-]+): )?(?P<target>[^ ]+)')
+
+# Messages from ansible-test which show that no integration targets are affected, as opposed to all targets being filtered out.
+unaffected_messages = ('No changes detected.', 'No tests found for detected changes.')
+
+
+def main():
+    """Main program entry point."""
+    tests = sys.argv[1:]
+    skip = []
+
+    if os.environ.get('BUILD_REASON') == 'PullRequest':
+        aliases = get_changed_aliases()
+
+        if aliases is not None:
+            skip = [test for test in tests if not is_affected(test, aliases)]
+
+    for test in tests:
+        print('%s: %s' % ('skip' if test in skip else 'run', test))
+
+    print('Skipping %d of %d tests.' % (len(skip), len(tests)))
+    print('##vso[task.setVariable variable=skip;isOutput=true] %s ' % ' '.join(skip))
+
+
+def get_changed_aliases():
+    """Return the set of aliases for integration targets affected by changes, or None if change detection is not possible."""
+    if os.path.isdir('tests/integration/targets'):
+        targets_path = 'tests/integration/targets'
+    else:
+        targets_path = 'test/integration/targets'
+
+    ensure_ansible_test()
+
+    aliases = set()
+
+    for command in commands:
+        targets = get_changed_targets(command)
+
+        if targets is None:
+            return None
+
+        for target in targets:
+            aliases_path = os.path.join(targets_path, target, 'aliases')
+
+            if not os.path.exists(aliases_path):
+                continue
+
+            with open(aliases_path) as aliases_file:
+                aliases.update(line.split('#')[0].strip() for line in aliases_file)
+
+    return aliases
+
+
+def get_changed_targets(command):
+    """Return the set of integration targets affected by changes for the given command, or None if they cannot be determined."""
+    process = subprocess.Popen(['ansible-test', command, '--changed', '--list-targets', '--color', 'no', '-v'] + list(allow_options),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    stderr = stderr.decode()
+
+    sys.stdout.write(stderr)
+
+    if process.returncode:
+        print('Change detection failed for "%s" with exit status %d, no tests will be skipped.' % (command, process.returncode))
+        return None
+
+    targets = set(stdout.decode().splitlines())
+
+    for line in stderr.splitlines():
+        match = classification_pattern.search(line)
+
+        if not match or match.group('command') not in (None, command):
+            continue
+
+        target = match.group('target')
+
+        if target == 'all':
+            print('Changes to "%s" require all "%s" targets, no tests will be skipped.' % (match.group('path'), command))
+            return None
+
+        if target != 'none':
+            targets.add(target)
+
+    if not targets and not any(message in stderr for message in unaffected_messages):
+        # Targets may have been filtered out, such as with "All targets skipped.", so the affected targets are unknown.
+        print('No changed targets were reported for "%s", no tests will be skipped.' % command)
+        return None
+
+    return targets
+
+
+def ensure_ansible_test():
+    """Install the devel version of ansible-test if it is not already available."""
+    os.environ['PATH'] = os.path.join(os.getcwd(), 'bin') + os.pathsep + os.environ['PATH']
+
+    if subprocess.call(['ansible-test', '--help'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+        return
+
+    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'https://github.com/ansible/ansible/archive/devel.tar.gz', '--disable-pip-version-check'])
+
+
+def is_affected(test, aliases):
+    """Return True if the given test may be affected by changes to integration targets with the given aliases."""
+    parts = test.split('/')
+
+    # skip the optional Ansible branch prefix
+    if re.search(r'^(devel|stable-[0-9.]+|[0-9]+\.[0-9]+)$', parts[0]):
+        parts = parts[1:]
+
+    incidental = parts[0] == 'i'
+
+    if incidental:
+        parts = parts[1:]
+
+    category = categories.get(parts[0])
+
+    if not category:
+        return True
+
+    parameters = parts[1:]
+
+    if len(parameters) >= 2 or (len(parameters) == 1 and parts[0] not in platform_types and '.' not in parameters[0]):
+        group = parameters[-1]
+    else:
+        group = None
+
+    if incidental:
+        pattern = r'^shippable/%s/incidental$' % category
+    elif group:
+        if not group.isdigit():
+            return True
+
+        pattern = r'^shippable/%s/group%s$' % (category, group)
+    else:
+        pattern = r'^shippable/%s/' % category
+
+    return any(re.search(pattern, alias) for alias in aliases)
+
+
+if __name__ == '__main__':
+    main()
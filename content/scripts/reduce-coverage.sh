@@ -0,0 +1,19 @@
+#!/usr/bin/env bash
+# Reduce the code coverage data combined from the test jobs in a stage to a single set of files for later processing.
+
+set -o pipefail -eu
+
+agent_temp_directory="$1"
+
+PATH="${PWD}/bin:${PATH}"
+
+if ! ansible-test --help >/dev/null 2>&1; then
+    # Install the devel version of ansible-test for reducing code coverage data.
+    # This is only used by Ansible Collections, which are typically tested against multiple Ansible versions (in separate jobs).
+    # Since a version of ansible-test is required that can work the output from multiple older releases, the devel version is used.
+    pip install https://github.com/ansible/ansible/archive/devel.tar.gz --disable-pip-version-check
+fi
+
+mkdir "${agent_temp_directory}/coverage/"
+
+ansible-test coverage combine --export "${agent_temp_directory}/coverage/" --venv --venv-system-site-packages --color -v
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""A script for indexing the classified test matrices of many working trees into a SQLite database for fleet-wide queries."""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import sqlite3
+import subprocess
+import sys
+import typing as t
+
+import ruamel.yaml
+
+try:
+    import argcomplete
+except ImportError:
+    argcomplete = None
+
+import migrate
+
+"""
+Schema of the inventory database.
+The "tests" view joins each classified matrix entry with the repository and branch it was indexed from.
+"""
+schema = '''
+CREATE TABLE IF NOT EXISTS trees (
+    id INTEGER PRIMARY KEY,
+    repository TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    path TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    error TEXT,
+    UNIQUE (repository, branch)
+);
+CREATE TABLE IF NOT EXISTS configs (
+    tree_id INTEGER NOT NULL REFERENCES trees (id),
+    position INTEGER NOT NULL,
+    test TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    job TEXT NOT NULL,
+    stage_label TEXT NOT NULL,
+    job_label TEXT NOT NULL,
+    type TEXT NOT NULL,
+    platform TEXT,
+    version TEXT,
+    group_name TEXT,
+    incidental INTEGER NOT NULL,
+    branch_prefix TEXT,
+    branch_key TEXT,
+    branch_value TEXT
+);
+CREATE TABLE IF NOT EXISTS stages (
+    tree_id INTEGER NOT NULL REFERENCES trees (id),
+    position INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    display_name TEXT NOT NULL,
+    jobs INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS configs_tree_id ON configs (tree_id);
+CREATE INDEX IF NOT EXISTS stages_tree_id ON stages (tree_id);
+CREATE VIEW IF NOT EXISTS tests AS SELECT trees.repository, trees.branch, configs.* FROM configs JOIN trees ON trees.id = configs.tree_id;
+'''
+
+"""
+Mapping of report names to predefined queries.
+"""
+reports = dict(
+    trees='SELECT repository, branch, path, error FROM trees ORDER BY repository, branch',
+    errors='SELECT repository, branch, error FROM trees WHERE error IS NOT NULL ORDER BY repository, branch',
+    docker='''SELECT job_label AS container, version, COUNT(DISTINCT repository) AS repositories, COUNT(DISTINCT repository || ' ' || branch) AS branches
+              FROM tests WHERE type = 'linux' GROUP BY job_label, version ORDER BY job_label, version''',
+    types='''SELECT type, COUNT(*) AS entries, COUNT(DISTINCT repository) AS repositories
+             FROM tests GROUP BY type ORDER BY entries DESC, type''',
+    jobs='''SELECT display_name AS stage, SUM(jobs) AS jobs, COUNT(*) AS branches
+            FROM stages GROUP BY display_name ORDER BY jobs DESC, display_name''',
+)
+
+
+def main() -> None:
+    """Main program entry point."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', metavar='PATH', default=os.path.expanduser('~/shippable-migration-inventory.db'), help='path to the inventory database (default: %(default)s)')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help='index working trees whose inputs have changed since they were last indexed')
+    index_parser.add_argument('working_trees', metavar='working_tree', nargs='+', help='path to a working tree to index, such as ~/shippable-migration/*/*/*')
+    index_parser.add_argument('--prune', action='store_true', help='remove indexed working trees which no longer exist')
+    index_parser.add_argument('--types', metavar='PATH', help='YAML file with test and docker type mappings, the same as the migration tool option')
+
+    query_parser = subparsers.add_parser('query', help='run a query or predefined report against the inventory')
+    query_group = query_parser.add_mutually_exclusive_group(required=True)
+    query_group.add_argument('sql', nargs='?', help='SQL query to run, using the trees, configs and stages tables or the tests view')
+    query_group.add_argument('--report', choices=sorted(reports), help='predefined report to run')
+
+    if argcomplete:
+        argcomplete.autocomplete(parser)
+
+    args = parser.parse_args()
+
+    with contextlib.closing(sqlite3.connect(args.database)) as connection:
+        connection.executescript(schema)
+
+        if args.command == 'index':
+            index(connection, args.working_trees, args.prune, args.types)
+        else:
+            query(connection, reports[args.report] if args.report else args.sql)
+
+
+def index(connection: sqlite3.Connection, working_trees: t.List[str], prune: bool, types_path: t.Optional[str]) -> None:
+    """
+    Index the given working trees, skipping those whose inputs have not changed since they were last indexed.
+    Working trees are keyed on repository and branch, so only the first of several working trees with the same key is indexed.
+    """
+    classifier = migrate.load_classifier(types_path) if types_path else migrate.default_classifier
+    tool_hash = get_tool_hash(types_path)
+    indexed = unchanged = failed = duplicate = 0
+    paths: t.Dict[t.Tuple[str, str], str] = {}
+
+    for working_tree in working_trees:
+        path = os.path.abspath(working_tree)
+        repository, is_collection = get_repository(path)
+        branch = get_branch(path)
+
+        if (repository, branch) in paths:
+            print(f'WARNING: Skipping {path} since {repository} {branch} was already indexed from: {paths[repository, branch]}', file=sys.stderr)
+            duplicate += 1
+            continue
+
+        paths[repository, branch] = path
+        input_hash = get_input_hash(path, is_collection, tool_hash)
+
+        row = connection.execute('SELECT id, input_hash, path FROM trees WHERE repository = ? AND branch = ?', (repository, branch)).fetchone()
+
+        if row and row[1] == input_hash and row[2] == path:
+            unchanged += 1
+            continue
+
+        if row and row[2] != path:
+            print(f'WARNING: Replacing {repository} {branch} previously indexed from {row[2]} with: {path}', file=sys.stderr)
+
+        with connection:
+            if row:
+                delete_tree(connection, row[0])
+
+            error = index_tree(connection, classifier, path, repository, branch, is_collection, input_hash)
+
+        if error:
+            print(f'WARNING: Unable to classify {repository} {branch}: {error}', file=sys.stderr)
+            failed += 1
+        else:
+            print(f'Indexed {repository} {branch}')
+            indexed += 1
+
+    pruned = 0
+
+    if prune:
+        with connection:
+            for tree_id, path in connection.execute('SELECT id, path FROM trees').fetchall():
+                if not os.path.exists(path):
+                    delete_tree(connection, tree_id)
+                    pruned += 1
+
+    print(f'Indexed {indexed}, failed {failed}, skipped {unchanged} unchanged and {duplicate} duplicate, and pruned {pruned} working trees.')
+
+
+def index_tree(connection: sqlite3.Connection, classifier: migrate.MatrixClassifier, path: str, repository: str, branch: str, is_collection: bool, input_hash: str) -> t.Optional[str]:
+    """Classify the matrix of the given working tree and store the results, returning the error message if classification failed."""
+    try:
+        parsed_matrix = migrate.parse_shippable_matrix(os.path.join(path, 'shippable.yml'))
+        classified_matrix = classifier.classify_matrix(path, is_collection, parsed_matrix)
+
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            content_stages = migrate.generate_stages(classified_matrix)
+    except Exception as ex:  # pylint: disable=broad-except
+        error = str(ex)
+        classified_matrix = []
+        content_stages = []
+    else:
+        error = None
+
+    tree_id = connection.execute('INSERT INTO trees (repository, branch, path, input_hash, error) VALUES (?, ?, ?, ?, ?)',
+                                 (repository, branch, path, input_hash, error)).lastrowid
+
+    connection.executemany('INSERT INTO configs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [(
+        tree_id,
+        position,
+        config.test,
+        config.stage_name,
+        ' '.join(config.name_components),
+        config.stage_label,
+        config.job_label,
+        config.type,
+        config.platform,
+        config.version,
+        config.group,
+        config.incidental,
+        config.branch_prefix,
+        config.branch_kvp[0] if config.branch_kvp else None,
+        config.branch_kvp[1] if config.branch_kvp else None,
+    ) for position, config in enumerate(classified_matrix)])
+
+    connection.executemany('INSERT INTO stages VALUES (?, ?, ?, ?, ?)', [(
+        tree_id,
+        position,
+        content_stage['stage'],
+        content_stage.get('displayName', content_stage['stage']),
+        migrate.count_jobs([content_stage]),
+    ) for position, content_stage in enumerate(content_stages) if content_stage['stage'] != 'Summary'])
+
+    return error
+
+
+def delete_tree(connection: sqlite3.Connection, tree_id: int) -> None:
+    """Delete the given working tree and its classified matrix from the inventory."""
+    connection.execute('DELETE FROM configs WHERE tree_id = ?', (tree_id,))
+    connection.execute('DELETE FROM stages WHERE tree_id = ?', (tree_id,))
+    connection.execute('DELETE FROM trees WHERE id = ?', (tree_id,))
+
+
+def query(connection: sqlite3.Connection, sql: str) -> None:
+    """Run the given query and print the results as aligned columns."""
+    cursor = connection.execute(sql)
+    header = [column[0] for column in cursor.description or []]
+    rows = [['' if value is None else str(value) for value in row] for row in cursor.fetchall()]
+
+    if not header:
+        return
+
+    widths = [max(len(value) for value in column) for column in zip(header, *rows)]
+
+    for row in [header] + rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+def get_repository(path: str) -> t.Tuple[str, bool]:
+    """Return the repository name of the given working tree, in the same format as the schedule ledger, and whether it is a collection."""
+    yaml = ruamel.yaml.YAML()
+
+    try:
+        with open(os.path.join(path, 'galaxy.yml')) as input_file:
+            galaxy = yaml.load(input_file)
+    except FileNotFoundError:
+        return 'ansible', False
+
+    return f'{galaxy["namespace"]}.{galaxy["name"]}', True
+
+
+def get_branch(path: str) -> str:
+    """Return the checked out branch of the given working tree, falling back to the directory name when it is not a git checkout."""
+    process = subprocess.run(['git', '-C', path, 'rev-parse', '--abbrev-ref', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False)
+    branch = process.stdout.decode().strip()
+
+    if process.returncode or not branch or branch == 'HEAD':
+        branch = os.path.basename(path)
+
+    return branch
+
+
+def get_tool_hash(types_path: t.Optional[str]) -> str:
+    """
+    Return a hash of the migration tool, this script and the given type mappings file, if any.
+    Changes to any of them can change classification, causing working trees to be indexed again.
+    """
+    digest = hashlib.sha256()
+
+    for path in (migrate.__file__, __file__, types_path):
+        if not path:
+            continue
+
+        with open(path, 'rb') as file:
+            digest.update(file.read() + b'\0')
+
+    return digest.hexdigest()
+
+
+def get_input_hash(path: str, is_collection: bool, tool_hash: str) -> str:
+    """Return a hash of the inputs the migration tool reads from the given working tree."""
+    digest = hashlib.sha256(tool_hash.encode())
+
+    for name in ('shippable.yml', 'galaxy.yml'):
+        try:
+            with open(os.path.join(path, name), 'rb') as file:
+                digest.update(name.encode() + b'\0' + file.read() + b'\0')
+        except FileNotFoundError:
+            pass
+
+    # Only the names of the test scripts are used by classification, to verify that each test type has a script.
+    script_directory = os.path.join(path, 'tests/utils/shippable' if is_collection else 'test/utils/shippable')
+
+    for directory in (script_directory, os.path.join(script_directory, 'incidental')):
+        if os.path.isdir(directory):
+            digest.update(os.path.relpath(directory, path).encode() + b'\0' + '\0'.join(sorted(os.listdir(directory))).encode() + b'\0')
+
+    return digest.hexdigest()
+
+
+if __name__ == '__main__':
+    main()
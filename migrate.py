@@ -4,6 +4,10 @@
 
 import argparse
 import dataclasses
+import functools
+import hashlib
+import io
+import json
 import os
 import re
 import shutil
@@ -72,13 +76,52 @@ split_incidental = (
     'Windows',
 )
 
+"""
+Tuple of Ansible branch names which may be given as the first part of a matrix entry, or as the value of a matrix key such as A_REV.
+"""
+ansible_branches = (
+    'devel',
+    'stable-2.10',  # only used by *.aws with A_REV
+    'stable-2.9',  # only used by *.aws with A_REV
+    '2.10',
+    '2.9',
+)
 
-@dataclasses.dataclass
+"""
+Tuple of the fields provided by the test parameters following the test type, indexed by the number of parameters.
+"""
+parameter_layouts = (
+    (),
+    ('version',),
+    ('version', 'group'),
+    ('platform', 'version', 'group'),
+)
+
+
+@dataclasses.dataclass(frozen=True)
 class TestConfig:
     """
     Parsed configuration representing a single test entry in the Shippable test matrix.
-    Includes properties used to generate the desired naming and structure for use in Azure Pipelines.
+    Includes attributes used to generate the desired naming and structure for use in Azure Pipelines.
+    Instances are immutable and may be shared, the derived attributes are computed once on creation.
     """
+    __slots__ = (
+        'stage_label',
+        'job_label',
+        'type',
+        'platform',
+        'version',
+        'group',
+        'incidental',
+        'branch_prefix',
+        'branch_kvp',
+        'branch_name',
+        'stage_name',
+        'name_components',
+        'test_components',
+        'test',
+    )
+
     stage_label: str
     job_label: str
     type: str
@@ -87,10 +130,16 @@ class TestConfig:
     group: t.Optional[str]
     incidental: bool
     branch_prefix: t.Optional[str]
-    branch_kvp: t.Optional[str]
+    branch_kvp: t.Optional[t.Tuple[str, str]]
 
-    @property
-    def stage_name(self) -> str:
+    def __post_init__(self) -> None:
+        object.__setattr__(self, 'branch_name', self._get_branch_name())
+        object.__setattr__(self, 'stage_name', self._get_stage_name())
+        object.__setattr__(self, 'name_components', self._get_name_components())
+        object.__setattr__(self, 'test_components', self._get_test_components())
+        object.__setattr__(self, 'test', self._get_test())
+
+    def _get_stage_name(self) -> str:
         """The name of the Azure Pipelines stage to place this test into."""
         stage_name = self.stage_label
 
@@ -103,10 +152,9 @@ class TestConfig:
             else:
                 stage_name = 'Incidental'
 
-        return stage_name
+        return sys.intern(stage_name)
 
-    @property
-    def branch_name(self) -> t.Optional[str]:
+    def _get_branch_name(self) -> t.Optional[str]:
         """The Ansible branch name to display in Azure Pipelines."""
         if self.branch_prefix:
             branch = self.branch_prefix
@@ -116,12 +164,11 @@ class TestConfig:
             branch = None
 
         if branch:
-            branch = branch.replace('stable-', '')
+            branch = sys.intern(branch.replace('stable-', ''))
 
         return branch
 
-    @property
-    def name_components(self) -> t.Tuple[str, ...]:
+    def _get_name_components(self) -> t.Tuple[str, ...]:
         """A tuple of components that make up the name of the job which is displayed in Azure Pipelines."""
         parts = [self.job_label]
 
@@ -136,11 +183,10 @@ class TestConfig:
 
         return tuple(parts)
 
-    @property
-    def test_components(self) -> t.Tuple[str, ...]:
+    def _get_test_components(self) -> t.Tuple[str, ...]:
         """A tuple of components that make up the test identifier which is passed to the shell scripts for execution."""
         if self.type == 'linux':
-            parts = [self.type, self.platform + self.version.replace(' ', '').replace('.', '')]
+            parts = [self.type, sys.intern(self.platform + self.version.replace(' ', '').replace('.', ''))]
         else:
             parts = [self.type, self.platform, self.version]
 
@@ -154,8 +200,7 @@ class TestConfig:
 
         return tuple(parts)
 
-    @property
-    def test(self) -> str:
+    def _get_test(self) -> str:
         """
         A reconstructed version of the original test identifier used on Shippable.
         Used for verification purposes to ensure the generated matrix matches the original.
@@ -170,19 +215,23 @@ class TestConfig:
         return test
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class Target:
+    __slots__ = ('name', 'type')
+
     name: str
     type: str
 
 
 @dataclasses.dataclass
 class Stage:
+    __slots__ = ('name', 'incidental', 'targets', 'configs', 'groups')
+
     name: str
     incidental: bool
-    targets: t.Dict[str, Target] = dataclasses.field(default_factory=dict)
-    configs: t.List[TestConfig] = dataclasses.field(default_factory=list)
-    groups: t.Set[str] = dataclasses.field(default_factory=set)
+    targets: t.Dict[str, Target]
+    configs: t.List[TestConfig]
+    groups: t.Set[str]
 
     @property
     def target_count(self):
@@ -197,12 +246,38 @@ class Stage:
         return self.target_count * self.group_count
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class MatrixItem:
+    __slots__ = ('raw', 'test', 'values', 'parts', 'line')
+
     raw: str
     test: str
     values: t.Dict[str, str]
     parts: t.Tuple[str, ...]
+    line: int
+
+
+@dataclasses.dataclass(frozen=True)
+class TestType:
+    """Classification rules for a Shippable test script, precomputed from the test type mappings."""
+    __slots__ = ('stage_label', 'job_label', 'layouts', 'docker')
+
+    stage_label: str
+    job_label: str
+    layouts: t.Dict[t.Tuple[int, bool], t.Tuple[str, ...]]
+    docker: bool
+
+
+class MatrixItemError(Exception):
+    """A problem with a single Shippable matrix entry."""
+
+
+class MatrixError(Exception):
+    """All problems found when classifying a Shippable matrix, reported together so they can be fixed at once."""
+    def __init__(self, problems: t.List[str]) -> None:
+        super().__init__(f'Found {len(problems)} problems in the Shippable matrix:\n' + '\n'.join(f'  {problem}' for problem in problems))
+
+        self.problems = problems
 
 
 def parse_shippable_matrix(path: str) -> t.List[MatrixItem]:
@@ -220,144 +295,256 @@ def parse_shippable_matrix(path: str) -> t.List[MatrixItem]:
         raw = item['env']
         values = dict(kvp.split('=') for kvp in raw.split(' '))
         test = values.pop('T')
-        parts = test.split('/')
-        matrix.append(MatrixItem(raw=raw, values=values, parts=parts, test=test))
+        parts = tuple(sys.intern(part) for part in test.split('/'))
+        matrix.append(MatrixItem(raw=raw, values=values, parts=parts, test=test, line=item.lc.line + 1))
 
     return matrix
 
 
-def get_test_config(test_type: str, parts: t.Tuple[str, ...], incidental: bool, branch_prefix: t.Optional[str], branch_kvp: t.Optional[str]) -> TestConfig:
-    labels = test_types.get(test_type)
+class MatrixClassifier:
+    """
+    Classifies Shippable matrix entries into test configs.
+    Dispatch tables are precomputed from the test type mappings above, extended or overridden by the given tables.
+    """
+    def __init__(
+            self,
+            extra_test_types: t.Optional[t.Dict[str, t.Tuple[str, str]]] = None,
+            extra_docker_types: t.Optional[t.Dict[str, t.Tuple[str, str]]] = None,
+    ) -> None:
+        self.test_types = {
+            name: TestType(
+                stage_label=stage_label,
+                job_label=job_label,
+                layouts=get_parameter_layouts(job_label),
+                docker=name == 'linux',
+            ) for name, (stage_label, job_label) in dict(test_types, **(extra_test_types or {})).items()
+        }
+
+        self.docker_types = {
+            name: (job_label, sys.intern(job_label.lower()), version) for name, (job_label, version) in dict(docker_types, **(extra_docker_types or {})).items()
+        }
+
+        # Results are cached, since matrix entries are frequently repeated across branches.
+        self.get_test_config = functools.lru_cache(maxsize=None)(self._get_test_config)
+
+    def _get_test_config(
+            self,
+            test_type: str,
+            parts: t.Tuple[str, ...],
+            incidental: bool,
+            branch_prefix: t.Optional[str],
+            branch_kvp: t.Optional[t.Tuple[str, str]],
+    ) -> TestConfig:
+        """Return the test config for the given test type and parameters."""
+        rules = self.test_types.get(test_type)
+
+        if not rules:
+            raise MatrixItemError(f'Unknown test type "{test_type}" extracted from test parts: {parts}')
+
+        fields = rules.layouts.get((len(parts), bool(parts) and '.' in parts[0]))
+
+        if fields is None:
+            raise MatrixItemError(f'Unhandled test type "{test_type}" with test parameters: {"/".join(parts)}')
+
+        parameters = dict(zip(fields, parts))
+
+        job_label = rules.job_label
+        platform = parameters.get('platform')
+        version = parameters.get('version')
+        group = parameters.get('group')
+
+        if rules.docker:
+            if platform or not version:
+                raise MatrixItemError(f'Unexpected test parameters: {"/".join(parts)}')
+
+            docker_type = self.docker_types.get(version)
+
+            if not docker_type:
+                raise MatrixItemError(f'Unexpected docker container reference "{version}" with test parameters: {"/".join(parts)}')
+
+            job_label, platform, version = docker_type
+
+        test_config = TestConfig(
+            stage_label=rules.stage_label,
+            job_label=job_label,
+            type=test_type,
+            platform=platform,
+            version=version,
+            group=group,
+            incidental=incidental,
+            branch_prefix=branch_prefix,
+            branch_kvp=branch_kvp,
+        )
 
-    if not labels:
-        raise Exception(f'Unknown test type "{test_type}" extracted from test parts: {parts}')
+        return test_config
 
-    stage_label, job_label = labels
+    def classify_matrix(self, path: str, is_collection: bool, matrix: t.List[MatrixItem]) -> t.List[TestConfig]:
+        """Return the test configs for the given matrix, raising a MatrixError with the problems found in all entries if any are invalid."""
+        if is_collection:
+            script_directory = os.path.join(path, 'tests/utils/shippable')
+        else:
+            script_directory = os.path.join(path, 'test/utils/shippable')
 
-    platform = None
-    version = None
-    group = None
+        scripts = {
+            False: get_file_names(script_directory),
+            True: get_file_names(os.path.join(script_directory, 'incidental')),
+        }
 
-    if len(parts) == 0:
-        pass
-    elif len(parts) == 1:
-        if job_label == 'Python':
-            if '.' in parts[0]:
-                version, = parts
+        test_configs = []
+        problems = []
+
+        for position, matrix_item in enumerate(matrix, start=1):
+            item_problems = []
+            test_config = self.classify_matrix_item(script_directory, scripts, matrix_item, item_problems)
+
+            if item_problems:
+                problems.extend(f'shippable.yml:{matrix_item.line} entry {position} "{matrix_item.raw}": {problem}' for problem in item_problems)
             else:
-                group, = parts
+                test_configs.append(test_config)
+
+        if problems:
+            raise MatrixError(problems)
+
+        return test_configs
+
+    def classify_matrix_item(
+            self,
+            script_directory: str,
+            scripts: t.Dict[bool, t.Set[str]],
+            matrix_item: MatrixItem,
+            problems: t.List[str],
+    ) -> t.Optional[TestConfig]:
+        """Return the test config for the given matrix item, adding any problems found to the given list."""
+        parts = matrix_item.parts
+        values = dict(matrix_item.values)
+
+        # Some collections run tests against specific Ansible branches.
+        # Extract this information from the matrix item before continuing.
+
+        branch_prefix = None
+        branch_kvp = None
+
+        if parts[0] in ansible_branches:
+            branch_prefix = parts[0]
+            parts = parts[1:]
         else:
-            version, = parts
-    elif len(parts) == 2:
-        version, group = parts
-    elif len(parts) == 3:
-        platform, version, group = parts
-    else:
-        raise Exception(f'Unhandled test type "{test_type}" with test parameters: {"/".join(parts)}')
-
-    if test_type == 'linux':
-        if platform or not version:
-            raise Exception(f'Unexpected test parameters: {"/".join(parts)}')
-
-        docker_type = docker_types.get(version)
-
-        if not docker_type:
-            raise Exception(f'Unexpected docker container reference "{version}" with test parameters: {"/".join(parts)}')
-
-        job_label = docker_type[0]
-        platform = docker_type[0].lower()
-        version = docker_type[1]
-
-    test_config = TestConfig(
-        stage_label=stage_label,
-        job_label=job_label,
-        type=test_type,
-        platform=platform,
-        version=version,
-        group=group,
-        incidental=incidental,
-        branch_prefix=branch_prefix,
-        branch_kvp=branch_kvp,
-    )
+            for key, value in list(values.items()):
+                if value in ansible_branches:
+                    branch_kvp = (key, value)  # A_REV used by *.aws
+                    values.pop(key)
+                    break
 
-    return test_config
+        # Check for any unused key value pairs.
+        # If there are any, then there's something about the matrix definition this tool doesn't understand.
 
+        if values:
+            problems.append(f'Unrecognized matrix key/value pairs detected: {values}')
 
-def classify_matrix_item(path: str, is_collection: bool, matrix_item: MatrixItem) -> TestConfig:
-    ansible_branches = (
-        'devel',
-        'stable-2.10',  # only used by *.aws with A_REV
-        'stable-2.9',  # only used by *.aws with A_REV
-        '2.10',
-        '2.9',
-    )
+        # Check to see if the test is an incidental test.
 
-    parts = matrix_item.parts
-    values = dict(matrix_item.values)
+        incidental = bool(parts) and parts[0] == 'i'
 
-    # Some collections run tests against specific Ansible branches.
-    # Extract this information from the matrix item before continuing.
+        if incidental:
+            parts = parts[1:]
 
-    branch_prefix = None
-    branch_kvp = None
+        # Determine the script which tests are delegated to.
+        # This should always be the first part of the matrix entry.
 
-    if parts[0] in ansible_branches:
-        branch_prefix = parts[0]
+        if not parts:
+            problems.append(f'No test type found in test entry: {matrix_item.test}')
+            return None
+
+        test_type = parts[0]
         parts = parts[1:]
-    else:
-        for key, value in list(values.items()):
-            if value in ansible_branches:
-                branch_kvp = (key, value)  # A_REV used by *.aws
-                values.pop(key)
-                break
 
-    # Check for any unused key value pairs.
-    # If there are any, then there's something about the matrix definition this tool doesn't understand.
+        try:
+            test_config = self.get_test_config(test_type, parts, incidental, branch_prefix, branch_kvp)
+        except MatrixItemError as ex:
+            problems.append(str(ex))
+            test_config = None
 
-    if values:
-        raise Exception(f'Unrecognized matrix key/value pairs detected: {values}')
+        if test_config and matrix_item.test != test_config.test:
+            problems.append(f'The post-processed test entry "{test_config.test}" does not match the original "{matrix_item.test}".')
 
-    # Check to see if the test is an incidental test.
+        # Verify the script associated with the test actually exists.
 
-    incidental = False
+        if f'{test_type}.sh' not in scripts[incidental]:
+            script_path = os.path.join(script_directory, 'incidental' if incidental else '', f'{test_type}.sh')
+            problems.append(f'Detected test type "{test_type}" does not have matching script: {script_path}')
 
-    if parts[0] == 'i':
-        incidental = True
-        parts = parts[1:]
+        return test_config
 
-    # Determine the script which tests are delegated to.
-    # This should always be the first part of the matrix entry.
 
-    test_type = parts[0]
-    parts = parts[1:]
+def get_parameter_layouts(job_label: str) -> t.Dict[t.Tuple[int, bool], t.Tuple[str, ...]]:
+    """
+    Return the parameter layouts for a test type with the given job name, keyed on the parameter count and whether the first parameter contains a ".".
+    A single parameter is a version, except for test types with a "Python" job name, where it is only a Python version if it contains a ".".
+    """
+    layouts = {}
 
-    test_config = get_test_config(test_type, parts, incidental, branch_prefix, branch_kvp)
+    for fields in parameter_layouts:
+        for dotted in (False, True):
+            layouts[(len(fields), dotted)] = fields
 
-    if matrix_item.test != test_config.test:
-        raise Exception(f'The post-processed test entry "{test_config.test}" does not match the original "{matrix_item.test}".')
+    if job_label == 'Python':
+        layouts[(1, False)] = ('group',)
 
-    # Verify the script associated with the test actually exists.
+    return layouts
 
-    if is_collection:
-        script_directory = os.path.join(path, f'tests/utils/shippable')
-    else:
-        script_directory = os.path.join(path, f'test/utils/shippable')
 
-    if incidental:
-        script_directory = os.path.join(script_directory, 'incidental')
+def load_classifier(path: str) -> MatrixClassifier:
+    """Return a classifier using the test and docker type mappings from the given YAML file in addition to the built-in mappings."""
+    yaml = ruamel.yaml.YAML()
+
+    with open(path) as file:
+        types = yaml.load(file) or {}
 
-    script_path = os.path.join(script_directory, f'{test_type}.sh')
+    tables = {}
 
-    if not os.path.exists(script_path):
-        raise Exception(f'Detected test type "{test_type}" does not have matching script: {script_path}')
+    for key in ('test_types', 'docker_types'):
+        table = tables[key] = {}
 
-    return test_config
+        for name, labels in (types.get(key) or {}).items():
+            if not isinstance(labels, list) or len(labels) != 2:
+                raise Exception(f'Expected a list of two values for "{name}" in "{key}" from: {path}')
+
+            table[str(name)] = (str(labels[0]), str(labels[1]))
+
+    return MatrixClassifier(tables['test_types'], tables['docker_types'])
+
+
+def get_file_names(path: str) -> t.Set[str]:
+    """Return the names of the files in the given directory, or an empty set if it does not exist."""
+    try:
+        return set(os.listdir(path))
+    except FileNotFoundError:
+        return set()
+
+
+default_classifier = MatrixClassifier()
+
+get_test_config = default_classifier.get_test_config
 
 
 def main() -> None:
     """Main program entry point."""
     parser = argparse.ArgumentParser()
     parser.add_argument('working_tree', help='path to the working tree to migrate')
+    parser.add_argument('--types', metavar='PATH', help='YAML file with "test_types" and "docker_types" mappings which extend or override the built-in mappings')
+    parser.add_argument('--plan', action='store_true', help='add a stage which uses change detection to skip unaffected jobs on pull requests')
+    parser.add_argument('--shard-jobs', metavar='COUNT', type=int, default=500, help='move stages into separate template files above this many jobs (default: %(default)s)')
+    parser.add_argument('--shard-size', metavar='BYTES', type=int, default=262144, help='move stages into separate template files above this config size (default: %(default)s)')
+    parser.add_argument('--expand-matrix', action='store_true', help='pass each stage pre-expanded jobs for the test template instead of using the matrix template')
+    parser.add_argument('--stage-coverage', action='store_true', help='reduce coverage data in each stage instead of all at once in the Summary stage')
+    parser.add_argument('--gate', metavar='STAGES', help='comma separated stage names which all other stages depend on, such as "Sanity,Units"')
+    parser.add_argument('--gate-pull-requests-only', action='store_true', help='apply the --gate option only to pull requests')
+    parser.add_argument('--stagger', action='store_true', help='assign each branch pattern, such as "stable-*", a nightly schedule slot based on a hash of the repository and pattern')
+    parser.add_argument('--schedule-window', metavar='START-END', default='6-12', help='UTC hours, end exclusive, in which staggered schedules are placed (default: %(default)s)')
+    parser.add_argument('--schedule-interval', metavar='MINUTES', type=int, default=10, help='minutes between staggered schedule slots (default: %(default)s)')
+    parser.add_argument('--schedule-ledger', metavar='PATH', help='JSON file recording the schedule slot and job count of each migrated repository and branch')
+    parser.add_argument('--pool-capacity', metavar='JOBS', type=int, help='maximum jobs of builds running at once across the ledger, requires --schedule-ledger')
+    parser.add_argument('--build-duration', metavar='MINUTES', type=int, default=60,
+                        help='estimated minutes for which a build occupies the pool, used with --pool-capacity (default: %(default)s)')
 
     if argcomplete:
         argcomplete.autocomplete(parser)
@@ -383,8 +570,18 @@ def main() -> None:
         galaxy = None
         is_collection = False
 
+    if args.pool_capacity and not args.schedule_ledger:
+        raise Exception('The --pool-capacity option requires the --schedule-ledger option.')
+
+    if args.schedule_ledger and not args.stagger:
+        raise Exception('The --schedule-ledger option requires the --stagger option.')
+
+    if args.build_duration <= 0:
+        raise Exception(f'Invalid build duration {args.build_duration}, it must be greater than zero.')
+
     if galaxy:
         checkout_path = os.path.join('ansible_collections', galaxy['namespace'], galaxy['name'])
+        repository = f'{galaxy["namespace"]}.{galaxy["name"]}'
         main_branch = 'main'  # best guess, not always correct
 
         branches = [
@@ -393,6 +590,7 @@ def main() -> None:
         ]
     else:
         checkout_path = 'ansible'
+        repository = 'ansible'
         main_branch = 'devel'
 
         branches = [
@@ -400,21 +598,66 @@ def main() -> None:
             'stable-*',
         ]
 
+    if args.types:
+        classifier = load_classifier(args.types)
+    else:
+        classifier = default_classifier
+
     parsed_matrix = parse_shippable_matrix(os.path.join(input_directory, 'shippable.yml'))
-    classified_matrix = [classify_matrix_item(input_directory, is_collection, item) for item in parsed_matrix]
+    classified_matrix = classifier.classify_matrix(input_directory, is_collection, parsed_matrix)
 
-    content_stages = generate_stages(classified_matrix)
+    if args.gate_pull_requests_only and not args.gate:
+        raise Exception('The --gate-pull-requests-only option requires the --gate option.')
 
-    content = generate_pipelines_config(content_stages, branches, checkout_path, main_branch, is_collection)
+    gates = [gate.strip() for gate in args.gate.split(',') if gate.strip()] if args.gate else None
 
-    write_content(content, content_directory, input_directory, output_directory, output_filename, is_collection)
+    content_stages = generate_stages(
+        classified_matrix,
+        plan=args.plan,
+        expand=args.expand_matrix,
+        stage_coverage=args.stage_coverage,
+        gates=gates,
+        gate_pull_requests_only=args.gate_pull_requests_only,
+    )
+
+    if args.stagger:
+        window = ScheduleWindow.parse(args.schedule_window, args.schedule_interval)
+        nightly_times = assign_nightly_times(repository, branches, count_jobs(content_stages), window, args.schedule_ledger, args.pool_capacity,
+                                             args.build_duration)
+    else:
+        nightly_times = None
 
+    content = generate_pipelines_config(content_stages, branches, checkout_path, main_branch, is_collection, nightly_times)
 
-def generate_stages(classified_matrix) -> t.List[t.Dict[str, t.Any]]:
+    stage_files = shard_stages(content, args.shard_jobs, args.shard_size)
+
+    write_content(content, stage_files, content_directory, input_directory, output_directory, output_filename, is_collection)
+
+
+def generate_stages(
+        classified_matrix: t.List[TestConfig],
+        plan: bool = False,
+        expand: bool = False,
+        stage_coverage: bool = False,
+        gates: t.Optional[t.List[str]] = None,
+        gate_pull_requests_only: bool = False,
+) -> t.List[t.Dict[str, t.Any]]:
+    """
+    Generate the Azure Pipelines stages for the given classified matrix.
+    When plan is True, a Plan stage is added which the test stages depend on, allowing jobs unaffected by a pull request to be skipped.
+    When expand is True, each stage passes its jobs directly to the test template, avoiding template expression evaluation in the matrix template.
+    The resulting job identifiers and display names are the same either way.
+    When stage_coverage is True, each test stage reduces its own coverage data as soon as its test jobs complete,
+    leaving the Summary stage to combine only one coverage artifact per stage.
+    When gates are given, all other test stages depend on the matching gate stages, optionally for pull requests only.
+    """
     stages = {}
 
     for item in classified_matrix:
-        stage = stages.setdefault(item.stage_name, Stage(item.stage_name, item.incidental))
+        stage = stages.get(item.stage_name)
+
+        if not stage:
+            stage = stages[item.stage_name] = Stage(name=item.stage_name, incidental=item.incidental, targets={}, configs=[], groups=set())
 
         if stage.incidental != item.incidental:
             raise Exception(f'Target "{item.stage_name}" has a test mismatch between "{stage.incidental}" and "{item.incidental}".')
@@ -448,6 +691,8 @@ def generate_stages(classified_matrix) -> t.List[t.Dict[str, t.Any]]:
     # Generate content.
 
     content_stages = []
+    gate_stage_names = []
+    matched_gates = set()
 
     for stage_name, stage in stages.items():
         test_prefix = tuple()
@@ -543,8 +788,31 @@ def generate_stages(classified_matrix) -> t.List[t.Dict[str, t.Any]]:
         if content_stage['displayName'] == content_stage['stage']:
             del content_stage['displayName']
 
+        if expand:
+            content_stage['jobs'][0] = generate_expanded_job(content_stage['jobs'][0]['parameters'])
+
+        if stage_coverage:
+            content_stage['jobs'].append(generate_stage_coverage_job(stage.name, content_stage['jobs'][0]))
+
+        stage_gates = get_stage_gates(stage, content_stage['stage'], gates) if gates else []
+
+        if stage_gates:
+            gate_stage_names.append(content_stage['stage'])
+            matched_gates.update(stage_gates)
+
         content_stages.append(content_stage)
 
+    if plan:
+        content_stages.insert(0, generate_plan_stage(content_stages))
+
+    if gates:
+        unmatched_gates = [gate for gate in gates if gate not in matched_gates]
+
+        if unmatched_gates:
+            raise Exception(f'Gates which do not match any stage: {", ".join(unmatched_gates)}')
+
+        apply_gate_stages(content_stages, gate_stage_names, gate_pull_requests_only)
+
     stage_names = [item['stage'] for item in content_stages]
 
     summary_stage = dict(
@@ -558,19 +826,269 @@ def generate_stages(classified_matrix) -> t.List[t.Dict[str, t.Any]]:
         ],
     )
 
+    if stage_coverage:
+        summary_stage['jobs'][0]['parameters'] = dict(
+            artifactPrefix='Stage Coverage',
+        )
+
     content_stages.append(summary_stage)
 
     return content_stages
 
 
+def get_stage_gates(stage: Stage, stage_id: str, gates: t.List[str]) -> t.List[str]:
+    """
+    Return the gates which match the given stage.
+    Gates match a stage by display name or identifier, such as "Incidental Docker" or "Docker_2_9".
+    Gates also match a stage by label, such as "Sanity" matching both "Sanity" and "Sanity 2.9", but never match incidental stages this way.
+    """
+    labels = set() if stage.incidental else set(config.stage_label for config in stage.configs)
+
+    return [gate for gate in gates if gate in (stage.name, stage_id) or gate in labels]
+
+
+def apply_gate_stages(content_stages: t.List[t.Dict[str, t.Any]], gate_stage_names: t.List[str], pull_requests_only: bool) -> None:
+    """Make each of the given stages which is not a gate depend on the named gate stages."""
+    print(f'Gated stages on: {", ".join(gate_stage_names)}')
+
+    for content_stage in content_stages:
+        if content_stage['stage'] in gate_stage_names or content_stage['stage'] == 'Plan':
+            continue
+
+        if pull_requests_only:
+            # Scheduled and other builds run all stages in parallel.
+            content_stage['dependsOn'].append({"${{ if eq(variables['Build.Reason'], 'PullRequest') }}": list(gate_stage_names)})
+        else:
+            content_stage['dependsOn'].extend(gate_stage_names)
+
+
+def generate_expanded_job(parameters: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+    """Generate a job which passes the jobs the given matrix template parameters would generate directly to the test template."""
+    expanded_job = dict(
+        template='templates/test.yml',
+        parameters=dict(
+            jobs=expand_matrix_jobs(parameters),
+        ),
+    )
+
+    return expanded_job
+
+
+def generate_stage_coverage_job(stage_name: str, test_job: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+    """Generate a job which reduces the coverage data from the test jobs the given matrix or test template job generates in the named stage."""
+    jobs = get_test_jobs(test_job)
+
+    coverage_job = dict(
+        template='templates/stage-coverage.yml',
+        parameters=dict(
+            jobs=[get_job_id(job['test']) for job in jobs],
+            labels=[f'{stage_name} {job["name"]}' for job in jobs],
+        ),
+    )
+
+    return coverage_job
+
+
+def get_job_id(test: str) -> str:
+    """Return the job identifier the test template generates for the given test."""
+    return 'test_' + test.replace('/', '_').replace('.', '_').replace('-', '_')
+
+
+def generate_plan_stage(content_stages: t.List[t.Dict[str, t.Any]]) -> t.Dict[str, t.Any]:
+    """Generate a Plan stage for the given test stages and make the test stages depend on it."""
+    tests = []
+
+    for content_stage in content_stages:
+        content_stage['dependsOn'] = ['Plan']
+
+        for job in content_stage['jobs']:
+            if os.path.basename(job['template']) in ('matrix.yml', 'test.yml'):
+                job['parameters']['plan'] = True
+                tests.extend(item['test'] for item in get_test_jobs(job))
+
+    plan_stage = dict(
+        stage='Plan',
+        dependsOn=[],
+        jobs=[
+            dict(
+                template='templates/plan.yml',
+                parameters=dict(
+                    tests=tests,
+                ),
+            ),
+        ],
+    )
+
+    return plan_stage
+
+
+def expand_matrix_jobs(parameters: t.Dict[str, t.Any]) -> t.List[t.Dict[str, str]]:
+    """Return the jobs, as name and test pairs, which the matrix template generates from the given parameters."""
+    name_format = parameters.get('nameFormat', '{0}')
+    test_format = parameters.get('testFormat', '{0}')
+    groups = parameters.get('groups')
+
+    targets = [
+        (
+            name_format.format(coalesce(target.get('name'), target.get('test'))),
+            test_format.format(coalesce(target.get('test'), target.get('name'))),
+        ) for target in parameters['targets']
+    ]
+
+    if not groups:
+        return [dict(name=name, test=test) for name, test in targets]
+
+    return [dict(name=f'{name} - {group}', test=f'{test}/{group}') for group in groups for name, test in targets]
+
+
+def get_test_jobs(job: t.Dict[str, t.Any]) -> t.List[t.Dict[str, str]]:
+    """Return the test jobs, as name and test pairs, which the given job generates if it uses the matrix or test template, otherwise an empty list."""
+    template = os.path.basename(job.get('template', ''))
+
+    if template == 'matrix.yml':
+        return expand_matrix_jobs(job['parameters'])
+
+    if template == 'test.yml':
+        return job['parameters']['jobs']
+
+    return []
+
+
+def count_jobs(content_stages: t.List[t.Dict[str, t.Any]]) -> int:
+    """Return the number of test jobs the matrix and test templates in the given stages generate."""
+    return sum(len(get_test_jobs(job)) for stage in content_stages for job in stage['jobs'])
+
+
+def coalesce(*values: t.Any) -> str:
+    """Return the first value which is not None or empty as a string, in the same way as the Azure Pipelines coalesce expression."""
+    for value in values:
+        if value is not None and value != '':
+            return str(value)
+
+    return ''
+
+
+@dataclasses.dataclass(frozen=True)
+class ScheduleWindow:
+    """A daily window of evenly spaced UTC schedule slots."""
+    start_hour: int
+    end_hour: int
+    interval: int
+
+    @classmethod
+    def parse(cls, value: str, interval: int) -> 'ScheduleWindow':
+        """Parse a window given as "START-END" UTC hours, with the end hour excluded."""
+        match = re.search(r'^(?P<start>[0-9]+)-(?P<end>[0-9]+)$', value)
+
+        if not match or not 0 <= int(match.group('start')) < int(match.group('end')) <= 24:
+            raise Exception(f'Invalid schedule window "{value}", expected "START-END" UTC hours such as "6-12".')
+
+        if interval <= 0 or 60 % interval:
+            raise Exception(f'Invalid schedule interval {interval}, it must evenly divide an hour.')
+
+        return cls(start_hour=int(match.group('start')), end_hour=int(match.group('end')), interval=interval)
+
+    @property
+    def slot_count(self) -> int:
+        return (self.end_hour - self.start_hour) * 60 // self.interval
+
+    def get_time(self, slot: int) -> t.Tuple[int, int]:
+        """Return the UTC (hour, minute) of the given slot."""
+        minutes = self.start_hour * 60 + slot * self.interval
+        return minutes // 60, minutes % 60
+
+
+def assign_nightly_times(
+        repository: str,
+        branches: t.List[str],
+        job_count: int,
+        window: ScheduleWindow,
+        ledger_path: t.Optional[str],
+        pool_capacity: t.Optional[int],
+        build_duration: int = 60,
+) -> t.Dict[str, t.Tuple[int, int]]:
+    """
+    Return a nightly UTC (hour, minute) for each of the given branches.
+    Each branch prefers the slot selected by a hash of the repository and branch, so the result is stable across migrations.
+    Branches are given as the patterns used by the schedule, so all branches matching a pattern such as "stable-*" share one slot,
+    and are recorded in the ledger as a single build.
+    With a ledger and pool capacity, each build is assumed to occupy the pool for the given duration in minutes from its start.
+    A slot is skipped in favor of the next slot with room if the job count of the builds which would be running at once exceeds the capacity.
+    Slots assigned here are recorded in the ledger, replacing any previous entries for the same repository and branch.
+    """
+    if ledger_path:
+        try:
+            with open(ledger_path) as ledger_file:
+                ledger = json.load(ledger_file)
+        except FileNotFoundError:
+            ledger = {}
+    else:
+        ledger = {}
+
+    nightly_times = {}
+
+    for branch in branches:
+        key = f'{repository} {branch}'
+        ledger.pop(key, None)
+
+        builds = []
+
+        for entry in ledger.values():
+            hour, minute = entry['time'].split(':')
+            builds.append((int(hour) * 60 + int(minute), entry.get('duration', build_duration), entry['jobs']))
+
+        preferred = int(hashlib.sha256(key.encode()).hexdigest(), 16) % window.slot_count
+        times = [window.get_time((preferred + offset) % window.slot_count) for offset in range(window.slot_count)]
+
+        if pool_capacity:
+            available = [time for time in times if get_peak_jobs(builds, time[0] * 60 + time[1], build_duration) + job_count <= pool_capacity]
+
+            if not available:
+                raise Exception(f'No schedule slot has room for the {job_count} jobs of branch "{branch}" within a pool capacity of {pool_capacity} jobs.')
+
+            hour, minute = available[0]
+        else:
+            hour, minute = times[0]
+
+        nightly_times[branch] = (hour, minute)
+        ledger[key] = dict(time=f'{hour:02d}:{minute:02d}', jobs=job_count, duration=build_duration)
+
+        print(f'Scheduled nightly build of branch "{branch}" at {hour:02d}:{minute:02d} UTC.')
+
+    if ledger_path:
+        with open(ledger_path, 'w') as ledger_file:
+            json.dump(dict(sorted(ledger.items())), ledger_file, indent=4)
+            ledger_file.write('\n')
+
+    return nightly_times
+
+
+def get_peak_jobs(builds: t.List[t.Tuple[int, int, int]], start: int, duration: int) -> int:
+    """
+    Return the highest job count of the given builds running at once while a build starting at the given minute of the day is running.
+    Builds are given as (start minute, duration in minutes, job count) and may run past midnight.
+    """
+    def get_jobs(minute: int) -> int:
+        return sum(jobs for build_start, build_duration, jobs in builds if (minute - build_start) % 1440 < build_duration)
+
+    # The number of running builds only increases when a build starts, so only those points need to be checked.
+    points = [start] + [build_start for build_start, _build_duration, _jobs in builds if (build_start - start) % 1440 < duration]
+
+    return max(get_jobs(point) for point in points)
+
+
 def generate_pipelines_config(
         content_stages: t.List[t.Dict[str, t.Any]],
         branches: t.List[str],
         checkout_path: str,
         main_branch: str,
         is_collection: bool,
+        nightly_times: t.Optional[t.Dict[str, t.Tuple[int, int]]] = None,
 ) -> t.Dict[str, t.Any]:
-    """Generate an Azure Pipelines configuration file."""
+    """
+    Generate an Azure Pipelines configuration file.
+    If nightly_times is given, each branch gets its own nightly schedule at the given UTC (hour, minute) instead of sharing a fixed hour.
+    """
     if is_collection:
         entry_point = 'tests/utils/shippable/shippable.sh'
     else:
@@ -581,6 +1099,29 @@ def generate_pipelines_config(
     else:
         nightly_hour = 7
 
+    if nightly_times:
+        schedules = [
+            dict(
+                cron=f'{minute} {hour} * * *',  # UTC
+                displayName=f'Nightly {branch}',
+                always=True,
+                branches=dict(
+                    include=[branch],
+                ),
+            ) for branch, (hour, minute) in nightly_times.items()
+        ]
+    else:
+        schedules = [
+            dict(
+                cron=f'0 {nightly_hour} * * *',  # UTC
+                displayName='Nightly',
+                always=True,
+                branches=dict(
+                    include=list(branches),
+                ),
+            ),
+        ]
+
     content = dict(
         trigger=dict(
             batch=True,
@@ -594,16 +1135,7 @@ def generate_pipelines_config(
                 include=list(branches),
             ),
         ),
-        schedules=[
-            dict(
-                cron=f'0 {nightly_hour} * * *',  # UTC
-                displayName='Nightly',
-                always=True,
-                branches=dict(
-                    include=list(branches),
-                ),
-            ),
-        ],
+        schedules=schedules,
         variables=[
             dict(
                 name='checkoutPath',
@@ -641,26 +1173,247 @@ def generate_pipelines_config(
     return content
 
 
+def shard_stages(content: t.Dict[str, t.Any], max_jobs: int, max_size: int) -> t.Dict[str, t.Dict[str, t.Any]]:
+    """
+    Move stages from the given Azure Pipelines config into separate stage template files if it exceeds the given job count or size.
+    Returns a dictionary of stage template file contents keyed on the path relative to the config.
+    The Summary stage remains in the config, since it depends on all other stages.
+    """
+    job_count = count_jobs(content['stages'])
+
+    if job_count <= max_jobs:
+        output = io.StringIO()
+        write_yaml(content, output)
+
+        if len(output.getvalue()) <= max_size:
+            return {}
+
+    stage_files = {}
+    stages = []
+
+    for stage in content['stages']:
+        if stage['stage'] == 'Summary':
+            stages.append(stage)
+            continue
+
+        for job in stage['jobs']:
+            # Template paths are relative to the including file, which is now in a subdirectory.
+            job['template'] = f'../{job["template"]}'
+
+        path = f'stages/{stage["stage"]}.yml'
+        stage_files[path] = dict(stages=[stage])
+        stages.append(dict(template=path))
+
+    print(f'Moved {len(stage_files)} stages with {job_count} jobs into separate stage template files.')
+
+    content['stages'] = stages
+
+    return stage_files
+
+
 def write_content(
         content: t.Dict[str, t.Any],
+        stage_files: t.Dict[str, t.Dict[str, t.Any]],
         content_directory: str,
         input_directory: str,
         output_directory: str,
         output_filename: str,
         is_collection: bool,
 ) -> None:
-    """Write the Azure Pipelines config and apply patches to existing scripts."""
+    """Write the Azure Pipelines config and stage template files, and apply patches to existing scripts."""
     shutil.copytree(content_directory, output_directory, dirs_exist_ok=True)
 
-    yaml = ruamel.yaml.YAML()
-    yaml.indent(sequence=4, offset=2)
+    stages_directory = os.path.join(output_directory, 'stages')
+
+    if os.path.exists(stages_directory):
+        # Remove stage template files from previous runs to keep the output deterministic.
+        shutil.rmtree(stages_directory)
+
+    if stage_files:
+        os.makedirs(stages_directory)
+
+    for path, stage_content in stage_files.items():
+        with open(os.path.join(output_directory, path), 'w') as output_file:
+            write_yaml(stage_content, output_file)
 
     with open(output_filename, 'w') as output_file:
-        yaml.dump(content, output_file, transform=yaml_transformer)
+        write_yaml(content, output_file)
 
     patch_scripts(input_directory, is_collection)
 
 
+def write_yaml(content: t.Dict[str, t.Any], output_file: t.TextIO) -> None:
+    """Write the given Azure Pipelines config to the given file, using the streaming YAML emitter where possible."""
+    try:
+        write_pipelines_config(content, output_file)
+    except UnsupportedYamlContent:
+        # Content outside the known schema is delegated to ruamel.yaml, which produces the same format.
+        output_file.seek(0)
+        output_file.truncate()
+        dump_pipelines_config(content, output_file)
+
+
+def dump_pipelines_config(content: t.Dict[str, t.Any], output_file: t.TextIO) -> None:
+    """Write the given Azure Pipelines config to the given file using ruamel.yaml."""
+    yaml = ruamel.yaml.YAML()
+    yaml.indent(sequence=4, offset=2)
+    yaml.dump(content, output_file, transform=yaml_transformer)
+
+
+class UnsupportedYamlContent(Exception):
+    """Raised when content cannot be written by the streaming YAML emitter."""
+
+
+"""
+Maximum line width used by ruamel.yaml before it wraps scalars onto multiple lines.
+"""
+yaml_line_width = 80
+
+"""
+Regular expression matching strings which ruamel.yaml would implicitly resolve to a type other than a string (YAML 1.2).
+Such strings must be quoted to round-trip as strings.
+"""
+yaml_implicit_pattern = re.compile(r'''
+    true|True|TRUE|false|False|FALSE
+    |~|null|Null|NULL
+    |<<|=
+    |(?=[-+0-9.])(?:
+        [-+]?(?:[0-9][0-9_]*)\.[0-9_]*(?:[eE][-+]?[0-9]+)?
+        |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
+        |[-+]?\.[0-9_]+(?:[eE][-+][0-9]+)?
+        |[-+]?\.(?:inf|Inf|INF)
+        |\.(?:nan|NaN|NAN)
+        |[-+]?0b[0-1_]+
+        |[-+]?0o?[0-7_]+
+        |[-+]?[0-9_]+
+        |[-+]?0x[0-9a-fA-F_]+
+        |[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]
+        |[0-9][0-9][0-9][0-9]-[0-9][0-9]?-[0-9][0-9]?(?:[Tt]|[\ \t]+)[0-9][0-9]?:[0-9][0-9]:[0-9][0-9](?:\.[0-9]*)?(?:[\ \t]*(?:Z|[-+][0-9][0-9]?(?::[0-9][0-9])?))?
+    )
+''', re.X)
+
+"""
+Regular expression matching a conservative subset of the strings which ruamel.yaml emits as plain (unquoted) scalars in block context.
+"""
+yaml_plain_pattern = re.compile(r"(?!\.\.\.)[A-Za-z0-9_./()$](?:[A-Za-z0-9_./()*{}\[\]$=+;,~<'-]|:(?=[^ ])| (?=[^ #]))*")
+
+"""
+Regular expression matching the strings which can be emitted as single quoted scalars without escaping.
+Only strings matching this pattern are supported by the streaming YAML emitter.
+"""
+yaml_single_quoted_pattern = re.compile(r"(?! )[ -&(-~]*(?<! )")
+
+"""
+Characters which cause ruamel.yaml to quote a string when they appear at the start of it.
+"""
+yaml_leading_indicators = frozenset('#,[]{}&*!|>%@`')
+
+
+def write_pipelines_config(content: t.Dict[str, t.Any], output_file: t.TextIO) -> None:
+    """
+    Write the given Azure Pipelines config directly to the given file, without building a ruamel.yaml document.
+    The output matches that of dump_pipelines_config for the schema produced by generate_pipelines_config.
+    Raises UnsupportedYamlContent for anything outside that schema.
+    """
+    write = output_file.write
+    seen: t.Set[int] = set()
+
+    for index, (key, value) in enumerate(content.items()):
+        if index:
+            write('\n')
+
+        write_yaml_mapping_item(write, seen, key, value, 0, '')
+
+
+def write_yaml_mapping(write: t.Callable[[str], t.Any], seen: t.Set[int], mapping: t.Dict[str, t.Any], indent: int, prefix: str) -> None:
+    """Write a non-empty block mapping, using the given prefix for the first line and the given indent for all remaining lines."""
+    check_yaml_alias(seen, mapping)
+
+    for key, value in mapping.items():
+        write_yaml_mapping_item(write, seen, key, value, indent, prefix)
+        prefix = ' ' * indent
+
+
+def write_yaml_mapping_item(write: t.Callable[[str], t.Any], seen: t.Set[int], key: str, value: t.Any, indent: int, prefix: str) -> None:
+    """Write a single key and value from a block mapping."""
+    if type(key) is not str or len(key) > 100 or not yaml_plain_pattern.fullmatch(key) or yaml_implicit_pattern.fullmatch(key):
+        raise UnsupportedYamlContent(f'Unsupported mapping key: {key!r}')
+
+    value_type = type(value)
+
+    if value_type is dict:
+        if value:
+            write(f'{prefix}{key}:\n')
+            write_yaml_mapping(write, seen, value, indent + 2, ' ' * (indent + 2))
+        else:
+            write(f'{prefix}{key}: {{}}\n')
+    elif value_type is list:
+        if value:
+            write(f'{prefix}{key}:\n')
+            write_yaml_sequence(write, seen, value, indent + 2)
+        else:
+            write(f'{prefix}{key}: []\n')
+    else:
+        write(f'{prefix}{key}: {format_yaml_scalar(value, len(prefix) + len(key) + 2)}\n')
+
+
+def write_yaml_sequence(write: t.Callable[[str], t.Any], seen: t.Set[int], sequence: t.List[t.Any], indent: int) -> None:
+    """Write a non-empty block sequence with the dash at the given indent."""
+    check_yaml_alias(seen, sequence)
+
+    prefix = ' ' * indent + '- '
+
+    for item in sequence:
+        if type(item) is dict and item:
+            write_yaml_mapping(write, seen, item, indent + 2, prefix)
+        elif type(item) in (dict, list):
+            raise UnsupportedYamlContent(f'Unsupported sequence item: {item!r}')
+        else:
+            write(f'{prefix}{format_yaml_scalar(item, indent + 2)}\n')
+
+
+def check_yaml_alias(seen: t.Set[int], value: t.Any) -> None:
+    """Raise UnsupportedYamlContent if the given collection has already been written, since ruamel.yaml would emit an anchor and alias for it."""
+    value_id = id(value)
+
+    if value_id in seen:
+        raise UnsupportedYamlContent('Unsupported repeated collection reference.')
+
+    seen.add(value_id)
+
+
+def format_yaml_scalar(value: t.Any, column: int) -> str:
+    """Return the given scalar formatted as ruamel.yaml would emit it in block context starting at the given column."""
+    value_type = type(value)
+
+    if value_type is str:
+        if not yaml_single_quoted_pattern.fullmatch(value):
+            raise UnsupportedYamlContent(f'Unsupported string: {value!r}')
+
+        if not value or value[0] in yaml_leading_indicators or yaml_implicit_pattern.fullmatch(value):
+            text = f"'{value}'"
+        elif yaml_plain_pattern.fullmatch(value):
+            text = value
+        else:
+            raise UnsupportedYamlContent(f'Unsupported string: {value!r}')
+
+        if column + len(text) > yaml_line_width:
+            raise UnsupportedYamlContent(f'Unsupported long string: {value!r}')
+
+        return text
+
+    if value_type is bool:
+        return 'true' if value else 'false'
+
+    if value_type is int:
+        return str(value)
+
+    if value_type is float and value == value and value not in (float('inf'), float('-inf')):
+        return repr(value).lower()
+
+    raise UnsupportedYamlContent(f'Unsupported scalar: {value!r}')
+
+
 def clean_values(values: t.List[str]) -> t.List[t.Union[int, float, str]]:
     """Return the given list with each value converted to an int or float if possible, otherwise as the original string."""
     return [clean_value(value) for value in sorted(values)]
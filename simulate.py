@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""A script for running the test jobs of a migrated Azure Pipelines configuration locally."""
+
+import argparse
+import concurrent.futures
+import dataclasses
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+
+import ruamel.yaml
+
+try:
+    import argcomplete
+except ImportError:
+    argcomplete = None
+
+import migrate
+
+
+@dataclasses.dataclass(frozen=True)
+class Job:
+    """A single test job from the Azure Pipelines configuration."""
+    stage: str
+    name: str
+    test: str
+
+    @property
+    def id(self) -> str:
+        return f'{self.stage.replace(" ", "_").replace(".", "_")}.{migrate.get_job_id(self.test)}'
+
+
+@dataclasses.dataclass(frozen=True)
+class JobResult:
+    """The outcome of running a single test job."""
+    job: Job
+    status: int
+    duration: float
+    log_path: str
+
+
+def main() -> None:
+    """Main program entry point."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('working_tree', help='path to the migrated working tree')
+    parser.add_argument('--jobs', metavar='COUNT', type=int,
+                        help='number of test jobs to run concurrently (default: 1, or the CPU count with --entry-point). '
+                             'Jobs share the working tree, including its test output and collection install, '
+                             'so only a stub entry point or 1 job gives reliable results')
+    parser.add_argument('--entry-point', metavar='PATH', help='script to run instead of the configured entryPoint, such as a stub for offline use')
+    parser.add_argument('--include', metavar='REGEX', help='only run jobs whose stage, name or test matches')
+    parser.add_argument('--output', metavar='PATH', help='directory for job logs (default: a new temporary directory)')
+    parser.add_argument('--list', action='store_true', help='list the jobs instead of running them')
+
+    if argcomplete:
+        argcomplete.autocomplete(parser)
+
+    args = parser.parse_args()
+
+    working_tree = os.path.abspath(args.working_tree)
+    config_path = os.path.join(working_tree, '.azure-pipelines', 'azure-pipelines.yml')
+
+    config = load_yaml(config_path)
+    variables = {item['name']: str(item['value']) for item in config.get('variables', [])}
+    jobs = expand_jobs(config_path, config)
+
+    if args.include:
+        jobs = [job for job in jobs if re.search(args.include, job.stage) or re.search(args.include, job.name) or re.search(args.include, job.test)]
+
+    if args.list:
+        for job in jobs:
+            print(f'{job.stage}: {job.name} ({job.test})')
+
+        return
+
+    entry_point = os.path.abspath(args.entry_point) if args.entry_point else variables['entryPoint']
+    concurrency = args.jobs or (os.cpu_count() if args.entry_point else 1)
+
+    if concurrency > 1 and not args.entry_point:
+        print('WARNING: Concurrent jobs running the real entry point share the working tree and may overwrite each other\'s results.', file=sys.stderr)
+
+    # Logs are kept outside the working tree, so they are not committed along with the generated configuration.
+    if args.output:
+        output_directory = os.path.abspath(args.output)
+        os.makedirs(output_directory, exist_ok=True)
+    else:
+        output_directory = tempfile.mkdtemp(prefix='simulate-')
+
+    print(f'Running {len(jobs)} jobs with a concurrency of {concurrency}, writing logs to: {output_directory}')
+
+    start = time.monotonic()
+    results = run_jobs(jobs, working_tree, entry_point, variables.get('coverageBranches', ''), output_directory, concurrency)
+    elapsed = time.monotonic() - start
+
+    failed = [result for result in results if result.status]
+
+    print()
+    print('Results:')
+
+    for result in results:
+        print(f'  {format_result(result)}')
+
+        if result.status:
+            print(f'    See: {result.log_path}')
+
+    print()
+    print(f'Passed {len(results) - len(failed)} and failed {len(failed)} of {len(results)} jobs in {format_duration(elapsed)} '
+          f'({format_duration(sum(result.duration for result in results))} of job time).')
+
+    if failed:
+        sys.exit(1)
+
+
+def load_yaml(path: str) -> t.Any:
+    """Load the given YAML file."""
+    yaml = ruamel.yaml.YAML(typ='safe')
+
+    with open(path) as file:
+        return yaml.load(file)
+
+
+def expand_jobs(config_path: str, config: t.Dict[str, t.Any]) -> t.List[Job]:
+    """Return the test jobs defined by the given Azure Pipelines configuration, including stages in stage template files."""
+    jobs = []
+
+    for stage in config['stages']:
+        if 'template' in stage:
+            stage_path = os.path.join(os.path.dirname(config_path), stage['template'])
+            stages = load_yaml(stage_path)['stages']
+        else:
+            stages = [stage]
+
+        for content_stage in stages:
+            stage_name = content_stage.get('displayName', content_stage['stage'])
+
+            for job in content_stage['jobs']:
+                # Only test jobs are run, other jobs such as Plan and code coverage require Azure Pipelines.
+                items = migrate.get_test_jobs(job)
+
+                jobs.extend(Job(stage=stage_name, name=str(item['name']), test=str(item['test'])) for item in items)
+
+    return jobs
+
+
+def run_jobs(jobs: t.List[Job], working_tree: str, entry_point: str, coverage_branches: str, output_directory: str, concurrency: int) -> t.List[JobResult]:
+    """Run the given jobs concurrently, returning the results in the same order as the jobs."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_job, job, working_tree, entry_point, coverage_branches, output_directory) for job in jobs]
+
+        for future in concurrent.futures.as_completed(futures):
+            print(format_result(future.result()), flush=True)
+
+        return [future.result() for future in futures]
+
+
+def run_job(job: Job, working_tree: str, entry_point: str, coverage_branches: str, output_directory: str) -> JobResult:
+    """Run the given job in the same way as the test template, writing the timestamped output to a log file."""
+    log_path = os.path.join(output_directory, f'{job.id}.log')
+    script = os.path.join(working_tree, '.azure-pipelines', 'scripts', 'run-tests.sh')
+
+    env = dict(os.environ)
+    env.setdefault('BUILD_REASON', 'Manual')
+    env.setdefault('BUILD_SOURCEBRANCHNAME', '')
+
+    start = time.monotonic()
+
+    with open(log_path, 'w') as log_file:
+        process = subprocess.run([script, entry_point, job.test, coverage_branches], cwd=working_tree, env=env, stdin=subprocess.DEVNULL, stdout=log_file,
+                                 stderr=subprocess.STDOUT, check=False)
+
+    return JobResult(job=job, status=process.returncode, duration=time.monotonic() - start, log_path=log_path)
+
+
+def format_result(result: JobResult) -> str:
+    """Return a one line summary of the given result."""
+    status = 'FAIL' if result.status else 'PASS'
+
+    return f'{status} {format_duration(result.duration)} {result.job.stage}: {result.job.name} ({result.job.test})'
+
+
+def format_duration(seconds: float) -> str:
+    """Return the given duration formatted in the same way as time-command.py."""
+    return '%02d:%02d' % (seconds // 60, seconds % 60)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""Benchmarks for the migration tool using synthetic test matrices."""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+import typing as t
+
+try:
+    import argcomplete
+except ImportError:
+    argcomplete = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrate  # pylint: disable=wrong-import-position
+
+
+def generate_matrix(count: int) -> t.List[migrate.TestConfig]:
+    """Return a synthetic classified matrix with the given number of entries spread across several stages."""
+    test_types = ('osx', 'rhel', 'freebsd', 'windows', 'units')
+    matrix = []
+
+    for index in range(count):
+        test_type = test_types[index % len(test_types)]
+        version = f'{index // 100}.{index % 100}'
+        group = str(index % 3 + 1)
+        matrix.append(migrate.get_test_config(test_type, (version, group), False, None, None))
+
+    return matrix
+
+
+def generate_content(count: int) -> t.Dict[str, t.Any]:
+    """Return a synthetic Azure Pipelines config with the given number of matrix entries."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        content_stages = migrate.generate_stages(generate_matrix(count))
+
+    return migrate.generate_pipelines_config(content_stages, ['main', 'stable-*'], 'ansible_collections/ns/name', 'main', True)
+
+
+def measure(func: t.Callable[[], t.Any], repeat: int) -> float:
+    """Return the best time in seconds of the given number of calls to the given function."""
+    best = float('inf')
+
+    for _iteration in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def generate_test_parameters() -> t.List[t.Tuple[str, t.Tuple[str, ...], bool, t.Optional[str], None]]:
+    """Return get_test_config arguments for the entries of a single realistic test matrix."""
+    distinct = []
+
+    for branch_prefix in (None, 'devel', '2.10', '2.9'):
+        for group in ('1', '2', '3'):
+            distinct.append(('sanity', (group,), False, branch_prefix, None))
+            distinct.append(('units', ('3.8', group), False, branch_prefix, None))
+            distinct.append(('windows', ('2019', group), False, branch_prefix, None))
+            distinct.append(('linux', ('centos7', group), False, branch_prefix, None))
+            distinct.append(('linux', ('ubuntu1804', group), True, branch_prefix, None))
+            distinct.append(('rhel', ('8.2', group), False, branch_prefix, None))
+            distinct.append(('cloud', ('2.7', group), False, branch_prefix, None))
+
+    return distinct
+
+
+def measure_instance_size(parameters: t.List[t.Tuple[str, t.Tuple[str, ...], bool, t.Optional[str], None]]) -> float:
+    """Return the average memory in bytes of a test config instance, including the derived attributes it holds, for the given arguments."""
+    get_test_config = migrate.get_test_config.__wrapped__
+    get_test_config(*parameters[0])  # allocate anything shared between instances, such as interned strings, outside of the measurement
+
+    tracemalloc.start()
+    configs = [get_test_config(*args) for args in parameters]
+    size = tracemalloc.get_traced_memory()[0] - sys.getsizeof(configs)
+    tracemalloc.stop()
+
+    return size / len(configs)
+
+
+def model(counts: t.List[int], repeat: int) -> None:
+    """
+    Measure time and memory per entry of the test config model, with and without caching.
+    Cached entries share instances, so the memory per entry is mostly list pointers, while the memory per unique instance is the size of the model itself.
+    """
+    variants = (
+        ('cached', migrate.get_test_config),
+        ('uncached', migrate.get_test_config.__wrapped__),
+    )
+
+    pipeline = generate_test_parameters()
+    instance_size = measure_instance_size(pipeline)
+
+    for count in counts:
+        # the same matrix is repeated, as it would be when migrating many branches and repositories
+        pipelines = [pipeline] * (count // len(pipeline))
+        count = len(pipeline) * len(pipelines)
+
+        for label, get_test_config in variants:
+            def build() -> t.List[t.List[migrate.TestConfig]]:
+                return [[get_test_config(*args) for args in parameters] for parameters in pipelines]
+
+            def run() -> None:
+                migrate.get_test_config.cache_clear()
+
+                with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                    for configs in build():
+                        migrate.generate_stages(configs)
+
+            elapsed = measure(run, repeat)
+
+            migrate.get_test_config.cache_clear()
+            tracemalloc.start()
+            matrices = build()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            instances = len(set(id(config) for configs in matrices for config in configs))
+            del matrices
+
+            print(f'model: {count} entries {label}: {elapsed / count * 1e6:.2f}us and {size / count:.0f} bytes per entry, '
+                  f'{instances} unique instances of {instance_size:.0f} bytes each')
+
+
+def emitter(counts: t.List[int], repeat: int) -> None:
+    """Compare the streaming YAML emitter with ruamel.yaml."""
+    for count in counts:
+        content = generate_content(count)
+
+        ruamel_output = io.StringIO()
+        streaming_output = io.StringIO()
+
+        migrate.dump_pipelines_config(content, ruamel_output)
+        migrate.write_pipelines_config(content, streaming_output)
+
+        if ruamel_output.getvalue() != streaming_output.getvalue():
+            raise Exception(f'Streaming YAML emitter output does not match ruamel.yaml output for {count} entries.')
+
+        ruamel_time = measure(lambda: migrate.dump_pipelines_config(content, io.StringIO()), repeat)
+        streaming_time = measure(lambda: migrate.write_pipelines_config(content, io.StringIO()), repeat)
+
+        print(f'emitter: {count} entries: ruamel.yaml {ruamel_time:.3f}s, streaming {streaming_time:.3f}s ({ruamel_time / streaming_time:.1f}x)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--emitter', action='store_true', help='benchmark the YAML emitter')
+    parser.add_argument('--model', action='store_true', help='benchmark the test config model')
+    parser.add_argument('--count', metavar='N', type=int, action='append', help='number of matrix entries (can be repeated)')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3, help='number of repetitions, the best is reported')
+
+    if argcomplete:
+        argcomplete.autocomplete(parser)
+
+    args = parser.parse_args()
+
+    if args.emitter:
+        emitter(args.count or [1000, 5000], args.repeat)
+
+    if args.model:
+        model(args.count or [100000], args.repeat)
+
+
+if __name__ == '__main__':
+    main()
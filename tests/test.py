@@ -2,9 +2,15 @@
 # PYTHON_ARGCOMPLETE_OK
 
 import argparse
+import concurrent.futures
+import difflib
+import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
 
 try:
     import argcomplete
@@ -12,6 +18,7 @@ except ImportError:
     argcomplete = None
 
 base_path = os.path.expanduser('~/shippable-migration')
+snapshot_path = os.path.expanduser('~/shippable-migration-snapshots')
 migration_tool = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrate.py')
 
 repos = {
@@ -98,10 +105,195 @@ def migrate():
             sys.stderr.write(process.stderr.decode())
 
 
+def get_input_paths(path):
+    """Return the paths, relative to the given working tree, of the inputs read by the migration tool."""
+    paths = ['shippable.yml']
+
+    if os.path.exists(os.path.join(path, 'galaxy.yml')):
+        paths.extend(['galaxy.yml', 'tests/utils/shippable'])
+    else:
+        paths.append('test/utils/shippable')
+
+    return paths
+
+
+def get_output_paths(path):
+    """Return the paths, relative to the given migrated working tree, of the files generated or patched by the migration tool."""
+    paths = [os.path.join('.azure-pipelines', 'azure-pipelines.yml')]
+    stages_path = os.path.join(path, '.azure-pipelines', 'stages')
+
+    if os.path.exists(stages_path):
+        paths.extend(os.path.join('.azure-pipelines', 'stages', name) for name in sorted(os.listdir(stages_path)))
+
+    if os.path.exists(os.path.join(path, 'galaxy.yml')):
+        paths.append('tests/utils/shippable/shippable.sh')
+    else:
+        paths.append('test/utils/shippable/shippable.sh')
+
+    return paths
+
+
+def copy_paths(source, destination, paths):
+    """Copy the given relative paths from the source directory to the destination directory."""
+    for path in paths:
+        source_path = os.path.join(source, path)
+        destination_path = os.path.join(destination, path)
+
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+
+        if os.path.isdir(source_path):
+            shutil.copytree(source_path, destination_path)
+        else:
+            shutil.copyfile(source_path, destination_path)
+
+
+def measure_migration(input_path, work_path, repeat):
+    """Migrate a copy of the given snapshot input into the given work path, returning the best time in seconds and peak memory in KiB."""
+    best_seconds = best_memory = None
+
+    for _iteration in range(repeat):
+        if os.path.exists(work_path):
+            shutil.rmtree(work_path)
+
+        shutil.copytree(input_path, work_path)
+
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, migration_tool, work_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.stdout.read()
+        _pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        process.stdout.close()
+
+        if process.returncode:
+            sys.stdout.write(output.decode())
+            raise Exception(f'Error migrating snapshot {input_path}')
+
+        best_seconds = seconds if best_seconds is None else min(seconds, best_seconds)
+        best_memory = usage.ru_maxrss if best_memory is None else min(usage.ru_maxrss, best_memory)
+
+    return best_seconds, best_memory
+
+
+def capture_snapshot(path, destination, repeat):
+    """Capture the migration inputs from the given working tree, along with the golden outputs, returning the baseline time and memory."""
+    if os.path.exists(destination):
+        shutil.rmtree(destination)
+
+    input_path = os.path.join(destination, 'input')
+
+    copy_paths(path, input_path, get_input_paths(path))
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        work_path = os.path.join(temp_path, 'work')
+        seconds, memory = measure_migration(input_path, work_path, repeat)
+        copy_paths(work_path, os.path.join(destination, 'golden'), get_output_paths(work_path))
+
+    return dict(seconds=seconds, memory=memory)
+
+
+def check_snapshot(destination, baseline, repeat, tolerance, time_slack, memory_tolerance):
+    """Migrate the given snapshot, returning a summary and a list of problems found when comparing with the golden outputs and the baseline."""
+    golden_path = os.path.join(destination, 'golden')
+    problems = []
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        work_path = os.path.join(temp_path, 'work')
+        seconds, memory = measure_migration(os.path.join(destination, 'input'), work_path, repeat)
+
+        for path in sorted(set(get_output_paths(work_path)) | set(get_output_paths(golden_path))):
+            expected = read_lines(os.path.join(golden_path, path))
+            actual = read_lines(os.path.join(work_path, path))
+
+            if expected != actual:
+                problems.append(f'output differs: {path}\n' + ''.join(difflib.unified_diff(expected, actual, f'golden/{path}', f'output/{path}')))
+
+    # very short migrations are noisy, so small absolute increases are never considered regressions
+    if seconds > baseline['seconds'] * (1 + tolerance) and seconds > baseline['seconds'] + time_slack:
+        problems.append(f'time regressed from {baseline["seconds"]:.3f}s to {seconds:.3f}s')
+
+    if memory > baseline['memory'] * (1 + memory_tolerance):
+        problems.append(f'peak memory regressed from {baseline["memory"]} KiB to {memory} KiB')
+
+    summary = f'{seconds:.3f}s (baseline {baseline["seconds"]:.3f}s), {memory} KiB (baseline {baseline["memory"]} KiB)'
+
+    return summary, problems
+
+
+def snapshot(repeat, jobs):
+    """Capture the migration inputs of each repo and branch, along with golden outputs and baseline timings."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+
+        for repo, branches in repos.items():
+            for branch in branches:
+                path = os.path.join(base_path, repo, branch)
+                destination = os.path.join(snapshot_path, repo, branch)
+                futures[f'{repo} {branch}'] = executor.submit(capture_snapshot, path, destination, repeat)
+
+        baselines = {}
+
+        for key, future in futures.items():
+            baselines[key] = future.result()
+            print(f'Captured snapshot of {key}: {baselines[key]["seconds"]:.3f}s, {baselines[key]["memory"]} KiB')
+
+    with open(os.path.join(snapshot_path, 'baseline.json'), 'w') as baseline_file:
+        json.dump(baselines, baseline_file, indent=4, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def regress(repeat, jobs, tolerance, time_slack, memory_tolerance):
+    """Migrate each snapshot in parallel, comparing the outputs with the golden outputs and the time and memory with the baseline."""
+    with open(os.path.join(snapshot_path, 'baseline.json')) as baseline_file:
+        baselines = json.load(baseline_file)
+
+    failures = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+
+        for repo, branches in repos.items():
+            for branch in branches:
+                key = f'{repo} {branch}'
+                destination = os.path.join(snapshot_path, repo, branch)
+                futures[key] = executor.submit(check_snapshot, destination, baselines[key], repeat, tolerance, time_slack, memory_tolerance)
+
+        for key, future in futures.items():
+            summary, problems = future.result()
+
+            print(f'{"FAIL" if problems else "PASS"} {key}: {summary}')
+
+            for problem in problems:
+                print(f'  {problem}')
+
+            if problems:
+                failures.append(key)
+
+    if failures:
+        raise Exception(f'Regressions detected in: {", ".join(failures)}')
+
+
+def read_lines(path):
+    """Return the lines of the given file, or an empty list if it does not exist."""
+    try:
+        with open(path) as file:
+            return file.readlines()
+    except FileNotFoundError:
+        return []
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--update', action='store_true')
     parser.add_argument('--migrate', action='store_true')
+    parser.add_argument('--snapshot', action='store_true', help='capture migration inputs from the clones, with golden outputs and baseline timings')
+    parser.add_argument('--regress', action='store_true', help='migrate the snapshots offline and check for output, time and memory regressions')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of snapshots to migrate in parallel')
+    parser.add_argument('--repeat', type=int, default=3, help='number of migrations of each snapshot, the best time and memory are used')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed fractional increase in migration time')
+    parser.add_argument('--time-slack', type=float, default=0.1, help='allowed absolute increase in migration time in seconds, regardless of tolerance')
+    parser.add_argument('--memory-tolerance', type=float, default=0.1, help='allowed fractional increase in peak memory')
 
     if argcomplete:
         argcomplete.autocomplete(parser)
@@ -114,6 +306,12 @@ def main():
     if args.migrate:
         migrate()
 
+    if args.snapshot:
+        snapshot(args.repeat, args.jobs)
+
+    if args.regress:
+        regress(args.repeat, args.jobs, args.tolerance, args.time_slack, args.memory_tolerance)
+
 
 if __name__ == '__main__':
     main()